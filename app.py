@@ -1,10 +1,159 @@
 import streamlit as st
+import asyncio
+import queue
+import random
+import re
+import threading
 import time
 import os
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 from google.generativeai import types
 
-# Set up Google API key
+# Retry settings for rate-limit (429) errors
+RATE_LIMIT_MAX_RETRIES = 5
+RATE_LIMIT_BASE_DELAY = 1    # Seconds
+RATE_LIMIT_MAX_DELAY = 30    # Seconds
+RETRY_TICK = 0.1             # Seconds between countdown updates while waiting to retry
+
+STREAM_POLL_INTERVAL = 0.05  # Seconds to wait for the next streamed chunk before polling again
+RENDER_MIN_CHARS = 32        # Flush streamed text once this many new characters have arrived
+RENDER_INTERVAL = 0.05       # ...or once this many seconds have passed since the last flush
+
+MODEL_NAME = "gemini-2.0-flash"
+MAX_CACHED_KEYS = 32         # API keys whose clients/models are kept in the resource cache
+
+# History window: at most MAX_HISTORY_TURNS turns are sent verbatim to the model. Past that,
+# older turns are summarized and only the last HISTORY_KEEP_TURNS are kept verbatim.
+MAX_HISTORY_TURNS = 10
+HISTORY_KEEP_TURNS = 5
+SUMMARY_PROMPT = "Summarize the following conversation in 3 bullets, keeping the patient's details and symptoms:"
+
+NO_RESPONSE_MESSAGE = "I'm sorry, I couldn't generate a response. Please try again."
+
+# Streamlit chat roles mapped to Gemini history roles
+ROLE_MAP = {"assistant": "model", "user": "user"}
+
+# Model settings (built once at import instead of on every request)
+GENERATION_CONFIG = {
+    "temperature": 0.3,  # Reduced for more focused responses
+    "top_p": 0.8,       # Reduced for more precise answers
+    "top_k": 40,        # Reduced for more focused responses
+}
+
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+    }
+]
+
+# System instruction for concise responses
+SYSTEM_INSTRUCTION = """You are a healthcare assistant. Be CONCISE and DIRECT.
+
+INTERACTION FLOW:
+1. Ask for name
+2. Ask for age  
+3. Ask for gender
+4. Ask for location (city/area)
+5. Ask about symptoms/issue
+6. Provide brief diagnosis and treatment
+
+RESPONSE FORMAT:
+- Keep responses under 3 sentences
+- Be direct and professional
+- No lengthy explanations
+- Focus on essential information only
+
+DIAGNOSIS FORMAT:
+- Possible condition: [brief diagnosis]
+- First aid: [2-3 key steps]
+- Medication: [common treatments]
+- See a doctor immediately for proper diagnosis
+- Nearby hospitals: [provide 1-2 options based on location]
+
+Ask for location to provide specific nearby hospitals. When the user's location is known,
+the nearby hospitals for it are given alongside their message."""
+
+# Nearby hospitals, only sent to the model once the user mentions a matching location
+CITY_HOSPITALS = {
+    "lagos": "Lagos: Lagos University Teaching Hospital, General Hospital Lagos",
+    "abuja": "Abuja: University of Abuja Teaching Hospital, National Hospital Abuja",
+    "covenant": "Covenant University area: Covenant University Hospital https://maps.app.goo.gl/njSWK8Gj8JPmjv5SA",
+    "port harcourt": "Port Harcourt: University of Port Harcourt Teaching Hospital",
+    "kano": "Kano: Aminu Kano Teaching Hospital",
+    "ibadan": "Ibadan: University College Hospital Ibadan",
+}
+
+@st.cache_resource
+def get_event_loop():
+    """
+    Return a background event loop that drives the async Gemini calls, so reading
+    the next chunk from the network overlaps with rendering on the script thread.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Run a coroutine on the background event loop and wait for its result
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+@st.cache_resource(max_entries=MAX_CACHED_KEYS)
+def get_clients(api_key):
+    """
+    Build sync and async Gemini clients bound to this API key. The global genai.configure
+    client is shared by every session in the process, so it's never used: one user's
+    requests must not go out on another user's key. Each client keeps its own gRPC
+    channel, reused across reruns by the resource cache.
+    """
+    client_options = {"api_key": api_key}
+    
+    # The async channel belongs to the event loop it's created on, so build it on ours
+    async def make_async_client():
+        return glm.GenerativeServiceAsyncClient(client_options=client_options)
+    
+    return glm.GenerativeServiceClient(client_options=client_options), run_async(make_async_client())
+
+@st.cache_resource(max_entries=MAX_CACHED_KEYS)
+def get_model(api_key, model_name=MODEL_NAME):
+    """
+    Build the GenerativeModel once per API key, wired to that key's own clients.
+    """
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        system_instruction=SYSTEM_INSTRUCTION
+    )
+    # GenerativeModel only falls back to the global client when these are unset
+    model._client, model._async_client = get_clients(api_key)
+    return model
+
+@st.cache_resource(max_entries=MAX_CACHED_KEYS)
+def get_summary_model(api_key, model_name=MODEL_NAME):
+    """
+    Build a plain model for history summaries. It has no healthcare system instruction,
+    so it summarizes instead of answering as the chatbot.
+    """
+    model = genai.GenerativeModel(model_name=model_name, safety_settings=SAFETY_SETTINGS)
+    model._client, model._async_client = get_clients(api_key)
+    return model
+
+# Set up Google API key and return it, or None if it isn't available
 def setup_google_api():
     # Check for API key in environment variables first
     api_key = os.environ.get("GOOGLE_API_KEY")
@@ -20,127 +169,198 @@ def setup_google_api():
     
     if not api_key:
         st.sidebar.warning("Please enter your Google AI API key to continue")
-        return False
+        return None
     
     # Initialize Google AI client
     try:
-        genai.configure(api_key=api_key)
-        return True
+        get_model(api_key)
+        return api_key
     except Exception as e:
         st.sidebar.error(f"Error initializing Google AI: {str(e)}")
-        return False
+        return None
 
-# Function to generate response with retry logic
-def generate_response_with_retry(prompt, conversation_history=None, max_retries=3, retry_delay=2):
+# Wait out a retry delay in short ticks, keeping a live countdown on screen
+def wait_with_countdown(placeholder, reason, delay, attempt, max_attempts):
+    deadline = time.monotonic() + delay
+    remaining = delay
+    while remaining > 0:
+        placeholder.warning(f"{reason}. Retrying in {remaining:.1f}s... (Attempt {attempt}/{max_attempts})")
+        time.sleep(min(RETRY_TICK, remaining))
+        remaining = deadline - time.monotonic()
+
+# Await a Gemini request on the background loop, retrying rate-limit and overloaded model errors
+def call_with_retry(request, status, max_retries=3, retry_delay=2):
     """
-    Generate a response with automatic retries for overloaded model errors.
+    Run request() (a function returning a fresh coroutine) with retries. Progress and
+    errors are shown in the status placeholder; returns None if the call failed.
     """
     retries = 0
-    while retries <= max_retries:
+    rate_limit_retries = 0
+    rate_limit_delay = RATE_LIMIT_BASE_DELAY
+    while True:
         try:
-            # Initialize the model with system instructions directly
-            generation_config = {
-                "temperature": 0.3,  # Reduced for more focused responses
-                "top_p": 0.8,       # Reduced for more precise answers
-                "top_k": 40,        # Reduced for more focused responses
-            }
+            result = run_async(request())
+            status.empty()
+            return result
+            
+        except google_exceptions.ResourceExhausted:
+            # Rate limited (429) - back off with jitter so clients don't retry in lockstep
+            rate_limit_retries += 1
+            if rate_limit_retries > RATE_LIMIT_MAX_RETRIES:
+                status.error("Rate limit reached. Please wait a moment and try again.")
+                return None
+            delay = random.uniform(0, rate_limit_delay)
+            wait_with_countdown(status, "Rate limited", delay, rate_limit_retries, RATE_LIMIT_MAX_RETRIES)
+            rate_limit_delay = min(rate_limit_delay * 2, RATE_LIMIT_MAX_DELAY)
             
-            safety_settings = [
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                }
-            ]
+        except (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError):
+            # Overloaded or transient server error (5xx) - retry
+            retries += 1
+            if retries > max_retries:
+                status.error("Maximum retry attempts reached. The service is currently unavailable.")
+                return None
+            wait_with_countdown(status, "Model overloaded", retry_delay, retries, max_retries)
+            # Increase delay for next retry (exponential backoff)
+            retry_delay *= 2
             
-            model = genai.GenerativeModel(
-                model_name="gemini-2.0-flash",
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+        except (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition) as e:
+            # The request itself is bad, so retrying won't help
+            status.error(f"Invalid request: {str(e)}")
+            return None
             
-            # Updated system instruction for concise responses
-            system_instruction = """You are a healthcare assistant. Be CONCISE and DIRECT.
+        except Exception as e:
+            # For other errors, don't retry
+            status.error(f"Error generating response: {str(e)}")
+            return None
 
-INTERACTION FLOW:
-1. Ask for name
-2. Ask for age  
-3. Ask for gender
-4. Ask for location (city/area)
-5. Ask about symptoms/issue
-6. Provide brief diagnosis and treatment
+# Function to generate response with retry logic
+def generate_response_with_retry(prompt, model, conversation_history=None, max_retries=3, retry_delay=2):
+    """
+    Generate a response with automatic retries for rate-limit and overloaded model errors.
+    """
+    # Create the chat once; a failed send leaves its history untouched, so retries just resend
+    chat = model.start_chat(history=conversation_history)
+    response = call_with_retry(
+        lambda: chat.send_message_async(prompt, stream=True), st.empty(), max_retries, retry_delay
+    )
+    if response is None:
+        return None, None
+    
+    # Return the streaming response object and the chat object
+    return response, chat
 
-RESPONSE FORMAT:
-- Keep responses under 3 sentences
-- Be direct and professional
-- No lengthy explanations
-- Focus on essential information only
+# Function to generate response (keeping original name for compatibility)
+def generate_response(prompt, model, conversation_history=None):
+    return generate_response_with_retry(prompt, model, conversation_history)
 
-DIAGNOSIS FORMAT:
-- Possible condition: [brief diagnosis]
-- First aid: [2-3 key steps]
-- Medication: [common treatments]
-- See a doctor immediately for proper diagnosis
-- Nearby hospitals: [provide 1-2 options based on location]
+# Yield the streamed text in batches, so st.write_stream re-renders once per batch rather than per chunk
+def iter_text(response):
+    chunks = queue.Queue()
+    
+    # Read the async stream on the background loop and hand text over through the queue
+    async def produce():
+        try:
+            async for chunk in response:
+                text = getattr(chunk, 'text', None)
+                if text:
+                    chunks.put(text)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(None)
+    
+    asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    parts = []
+    pending = 0
+    last_flush = time.monotonic()
+    while True:
+        try:
+            item = chunks.get(timeout=STREAM_POLL_INTERVAL)
+        except queue.Empty:
+            item = ""
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        if item:
+            parts.append(item)
+            pending += len(item)
+        # Flush once enough text has arrived or enough time has passed
+        now = time.monotonic()
+        if parts and (pending >= RENDER_MIN_CHARS or now - last_flush >= RENDER_INTERVAL):
+            yield "".join(parts)
+            parts = []
+            pending = 0
+            last_flush = now
+    if parts:
+        yield "".join(parts)
 
-LOCATION-BASED HOSPITALS:
-- Lagos: Lagos University Teaching Hospital, General Hospital Lagos
-- Abuja: University of Abuja Teaching Hospital, National Hospital Abuja  
-- Covenant University area: Covenant University Hospital https://maps.app.goo.gl/njSWK8Gj8JPmjv5SA
-- Port Harcourt: University of Port Harcourt Teaching Hospital
-- Kano: Aminu Kano Teaching Hospital
-- Ibadan: University College Hospital Ibadan
+# Format the hospital listing for the given locations
+def hospital_listing(cities):
+    return "NEARBY HOSPITALS:\n" + "\n".join(f"- {CITY_HOSPITALS[city]}" for city in cities)
 
-Ask for location to provide specific nearby hospitals."""
-            
-            if conversation_history:
-                # Create chat with existing history
-                chat = model.start_chat(history=conversation_history)
-                response = chat.send_message(prompt, stream=True)
-            else:
-                # First message - create a chat and prepend our instructions
-                chat = model.start_chat()
-                
-                # For the first message, prefix with our instructions
-                prefixed_prompt = f"{system_instruction}\n\nUser: {prompt}"
-                response = chat.send_message(prefixed_prompt, stream=True)
-            
-            # Return the streaming response object and the chat object
-            return response, chat
-            
-        except Exception as e:
-            error_message = str(e)
-            
-            # If it's an overloaded model error, retry
-            if "503" in error_message and "overloaded" in error_message.lower():
-                retries += 1
-                if retries <= max_retries:
-                    st.warning(f"Model overloaded. Retrying in {retry_delay} seconds... (Attempt {retries}/{max_retries})")
-                    time.sleep(retry_delay)
-                    # Increase delay for next retry (exponential backoff)
-                    retry_delay *= 2
-                else:
-                    st.error("Maximum retry attempts reached. The service is currently unavailable.")
-                    return None, None
-            else:
-                # For other errors, don't retry
-                st.error(f"Error generating response: {error_message}")
-                return None, None
+# Append the nearby hospitals for any location mentioned in the prompt, remembering the
+# locations so the listing can be re-attached once older turns are summarized
+def with_hospital_info(prompt):
+    lowered = prompt.lower()
+    cities = [city for city in CITY_HOSPITALS if re.search(rf"\b{re.escape(city)}\b", lowered)]
+    if not cities:
+        return prompt
+    for city in cities:
+        if city not in st.session_state.hospital_cities:
+            st.session_state.hospital_cities.append(city)
+    return f"{prompt}\n\n{hospital_listing(cities)}"
 
-# Function to generate response (keeping original name for compatibility)
-def generate_response(prompt, conversation_history=None):
-    return generate_response_with_retry(prompt, conversation_history)
+# Add a message to the chat history, keeping the Gemini-format history in lockstep.
+# model_content is what the model sees, if it differs from what is displayed.
+def add_message(role, content, model_content=None):
+    st.session_state.messages.append({"role": role, "content": content})
+    text = content if model_content is None else model_content
+    st.session_state.gemini_history.append({"role": ROLE_MAP[role], "parts": [{"text": text}]})
+
+# Summarize older turns once the history gets long, so the context sent to the model stays bounded
+def compact_history(model):
+    """
+    Run at the end of a turn. Once the history holds MAX_HISTORY_TURNS turns, replace all
+    but the last HISTORY_KEEP_TURNS of them with a short summary, so the next request
+    never sends more than MAX_HISTORY_TURNS turns verbatim. Keeping fewer turns than the
+    limit means the summary call runs every few turns rather than on every turn.
+    Returns True if the history was compacted.
+    """
+    history = st.session_state.gemini_history
+    
+    # User/model pairs (plus the opening greeting)
+    if len(history) <= 2 * MAX_HISTORY_TURNS:
+        return False
+    
+    keep = 2 * HISTORY_KEEP_TURNS
+    older, recent = history[:-keep], history[-keep:]
+    transcript = "\n".join(
+        f"{msg['role']}: {' '.join(part['text'] for part in msg['parts'])}" for msg in older
+    )
+    status = st.empty()
+    status.info("Summarizing earlier conversation...")
+    result = call_with_retry(lambda: model.generate_content_async(f"{SUMMARY_PROMPT}\n\n{transcript}"), status)
+    if result is None:
+        # Keep the full history rather than failing the turn; the error stays in the status
+        return False
+    try:
+        summary = result.text
+    except ValueError as e:
+        # No text came back (e.g. the summary was blocked)
+        status.warning(f"Could not summarize earlier conversation: {str(e)}")
+        return False
+    
+    # Keep the hospital listing for the user's location, which the summary may drop
+    summary_text = f"Summary of earlier conversation:\n{summary}"
+    if st.session_state.hospital_cities:
+        summary_text += f"\n\n{hospital_listing(st.session_state.hospital_cities)}"
+    
+    # Fold the summary into the first kept user message so roles still alternate
+    first = recent[0]
+    recent[0] = {"role": first["role"], "parts": [{"text": summary_text}] + first["parts"]}
+    st.session_state.gemini_history = recent
+    return True
 
 # Main app
 def main():
@@ -151,16 +371,21 @@ def main():
     if "messages" not in st.session_state:
         st.session_state.messages = []
     
-    if "chat_session" not in st.session_state:
-        st.session_state.chat_session = None
+    if "gemini_history" not in st.session_state:
+        st.session_state.gemini_history = []
+    
+    if "hospital_cities" not in st.session_state:
+        st.session_state.hospital_cities = []
     
     # Configure sidebar
     st.sidebar.title("Settings")
     st.sidebar.info("This chatbot provides preliminary health guidance. Always consult healthcare professionals for accurate diagnosis and treatment.")
     
     # Setup Google API
-    if not setup_google_api():
+    api_key = setup_google_api()
+    if api_key is None:
         st.stop()
+    model = get_model(api_key)
     
     # Display chat messages from history
     for message in st.session_state.messages:
@@ -172,58 +397,57 @@ def main():
         with st.chat_message("assistant"):
             initial_message = "Hello! I'm your healthcare assistant. What's your name?"
             st.markdown(initial_message)
-        st.session_state.messages.append({"role": "assistant", "content": initial_message})
+        add_message("assistant", initial_message)
     
     # Handle user input
     if prompt := st.chat_input("Type your message here..."):
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        # Add user message to chat history, with hospital info for the model if a location came up
+        model_prompt = with_hospital_info(prompt)
+        add_message("user", prompt, model_prompt)
         
         # Display user message
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        # Prepare the conversation history in the format expected by Google Gemini
-        history = []
-        for msg in st.session_state.messages[:-1]:  # All except the latest user message
-            role = "model" if msg["role"] == "assistant" else "user"
-            history.append({"role": role, "parts": [{"text": msg["content"]}]})
-        
         # Get streaming response from model
         with st.chat_message("assistant"):
             full_response = ""
             message_placeholder = st.empty()
             
             # Generate response
-            if st.session_state.chat_session:
-                # Use existing chat session
-                response, chat = generate_response(prompt, history)
-            else:
-                # Create a new chat session
-                response, chat = generate_response(prompt)
-                if chat:
-                    st.session_state.chat_session = chat
+            history = st.session_state.gemini_history[:-1]  # All except the latest user message
+            response, _ = generate_response(model_prompt, model, history)
             
             # Stream the response
+            failed = response is None
             if response:
                 try:
-                    for chunk in response:
-                        if hasattr(chunk, 'text') and chunk.text:
-                            full_response += chunk.text
-                            message_placeholder.markdown(full_response + "▌")
-                            time.sleep(0.01)
-                    
-                    message_placeholder.markdown(full_response)
+                    # write_stream re-renders on every item, so iter_text hands it batched text.
+                    # It returns a list instead of a string when nothing was streamed.
+                    full_response = message_placeholder.write_stream(iter_text(response))
+                    if not isinstance(full_response, str) or not full_response:
+                        full_response = NO_RESPONSE_MESSAGE
+                        message_placeholder.markdown(full_response)
+                        failed = True
                 except Exception as e:
                     error_message = f"Error while streaming response: {str(e)}"
                     message_placeholder.markdown(error_message)
                     full_response = error_message
+                    failed = True
             else:
-                message_placeholder.markdown("I'm sorry, I couldn't generate a response. Please try again.")
-                full_response = "I'm sorry, I couldn't generate a response. Please try again."
+                message_placeholder.markdown(NO_RESPONSE_MESSAGE)
+                full_response = NO_RESPONSE_MESSAGE
         
         # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": full_response})
+        if failed:
+            # Show the error but leave the failed turn out of what the model sees, like ChatSession.rewind()
+            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            st.session_state.gemini_history.pop()
+        else:
+            add_message("assistant", full_response)
+        
+        # Summarize older turns once the reply is done, so the next request is already bounded
+        compact_history(get_summary_model(api_key))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file